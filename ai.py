@@ -1,14 +1,39 @@
-from openai import OpenAI
+from openai import AsyncOpenAI
+import asyncio
+import httpx
+import logging
 import os
-import json
-import re
-from typing import Dict
+import sys
+import orjson
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional, Tuple
 
-client = OpenAI(
+from llm_cache import TTLCache, make_key
+
+logger = logging.getLogger("reino_backend.ai")
+
+# один клиент на процесс: keep-alive + HTTP/2 переиспользуют TLS-соединения
+client = AsyncOpenAI(
     api_key=os.getenv("OPENAI_API_KEY"),
     timeout=60.0,
+    # SDK сам повторяет 429/5xx с экспоненциальной задержкой и учётом Retry-After
+    max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "3")),
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        http2=True,
+    ),
 )
 
+# ограничение одновременных запросов к OpenAI (под RPM/TPM аккаунта):
+# лишние запросы ждут в очереди, а не получают 429
+_openai_semaphore = asyncio.Semaphore(int(os.getenv("OPENAI_MAX_CONCURRENCY", "20")))
+
+PROMPTS_DIR = Path(__file__).resolve().parent / "prompts"
+
+# единственный кеш ответов модели: одинаковые (промпты, model, lang, prompt)
+# не ходят в API 7 дней
+_response_cache = TTLCache(maxsize=4096, ttl=7 * 24 * 3600)
+
 # допустимые значения
 
 LANG_INSTRUCTIONS = {
@@ -18,163 +43,238 @@ LANG_INSTRUCTIONS = {
     "pt": "Escreva todo o texto ESTRITAMENTE em português.",
 }
 
-ALLOWED_ANIMALS = {
-    "Wolf",
-    "Lion",
-    "Tiger",
-    "Lynx",
-    "Panther",
-    "Bear",
-    "Fox",
-    "Wolverine",
-    "Deer",
-    "Monkey",
-    "Rabbit",
-    "Buffalo",
-    "Ram",
-    "Capybara",
-    "Elephant",
-    "Horse",
-    "Eagle",
-    "Owl",
-    "Raven",
-    "Parrot",
-    "Snake",
-    "Crocodile",
-    "Turtle",
-    "Lizard",
-}
-
-ALLOWED_ELEMENTS = {"Воздух", "Вода", "Огонь", "Земля"}
-ALLOWED_GENDERS = {"male", "female", "unspecified"}
-
+# строки интернированы: проверка ответа модели сводится к сравнению указателей
+ALLOWED_ANIMALS = frozenset(
+    map(
+        sys.intern,
+        {
+            "Wolf",
+            "Lion",
+            "Tiger",
+            "Lynx",
+            "Panther",
+            "Bear",
+            "Fox",
+            "Wolverine",
+            "Deer",
+            "Monkey",
+            "Rabbit",
+            "Buffalo",
+            "Ram",
+            "Capybara",
+            "Elephant",
+            "Horse",
+            "Eagle",
+            "Owl",
+            "Raven",
+            "Parrot",
+            "Snake",
+            "Crocodile",
+            "Turtle",
+            "Lizard",
+        },
+    )
+)
 
-def _extract_json(text: str) -> Dict:
+ALLOWED_ELEMENTS = frozenset(map(sys.intern, {"Воздух", "Вода", "Огонь", "Земля"}))
+ALLOWED_GENDERS = frozenset(map(sys.intern, {"male", "female", "unspecified"}))
 
-    try:
-        return json.loads(text)
-    except json.JSONDecodeError:
-        match = re.search(r"\{[\s\S]*\}", text)
-        if not match:
-            raise ValueError("JSON not found in model output")
-        return json.loads(match.group())
-
-
-def run_short_analysis(prompt: str, lang: str) -> dict:
-    language_rule = LANG_INSTRUCTIONS.get(lang, LANG_INSTRUCTIONS["ru"])
-
-    system_instruction = """
-    {language_rule}
-    
-Верни СТРОГО JSON.
-Запрещено добавлять любые поля, кроме перечисленных.
-
-Ты аналитическая модель системы «24 зверя × 4 стихии».
-
-❗ Используй ТОЛЬКО утверждённые архетипы.
-❗ НЕ используй метафорические или альтернативные названия.
-❗ НЕ смешивай языки.
-❗ НЕ добавляй текст вне JSON.
-
-animal — один из:
-Wolf, Lion, Tiger, Lynx, Panther, Bear, Fox, Wolverine, Deer,
-Monkey, Rabbit, Buffalo, Ram, Capybara, Elephant, Horse,
-Eagle, Owl, Raven, Parrot, Snake, Crocodile, Turtle, Lizard
-
-element — строго одно из: Воздух | Вода | Огонь | Земля
-genderForm — male | female | unspecified
-
-Формат (СТРОГО):
-{{
-  "animal": "Wolf",
-  "element": "Огонь",
-  "genderForm": "male"
-}}
-""".strip()
-
-    response = client.responses.create(
-        model="gpt-4.1-mini",
-        input=[
-            {"role": "system", "content": system_instruction},
-            {"role": "user", "content": prompt},
-        ],
-        max_output_tokens=120,
-    )
 
-    raw_text = (response.output_text or "").strip()
-    data = _extract_json(raw_text)
+def _load_prompt(filename: str) -> str:
+    # промпты читаются один раз при импорте
+    return (PROMPTS_DIR / filename).read_text(encoding="utf-8").strip()
 
-    animal = data.get("animal")
-    element = data.get("element")
-    gender_form = data.get("genderForm", "unspecified")
 
-    # 🛡️ строгая валидация
-    if animal not in ALLOWED_ANIMALS:
-        raise ValueError(f"Invalid animal: {animal}")
+SYSTEM_SHORT_ANALYSIS = _load_prompt("short_analysis.txt")
+SYSTEM_SHORT_TEXT = _load_prompt("short_text.txt")
+SYSTEM_FULL_ANALYSIS = _load_prompt("full_analysis.txt")
+SHORT_TEXT_RULES = _load_prompt("short_rules.txt")
+FULL_ANALYSIS_RULES = _load_prompt("full_rules.txt")
 
-    if element not in ALLOWED_ELEMENTS:
-        raise ValueError(f"Invalid element: {element}")
+# версия — хеш всех промптов: правка любого файла в prompts/ сбрасывает кеш
+PROMPT_VERSION = make_key(
+    SYSTEM_SHORT_ANALYSIS,
+    SYSTEM_SHORT_TEXT,
+    SYSTEM_FULL_ANALYSIS,
+    SHORT_TEXT_RULES,
+    FULL_ANALYSIS_RULES,
+)
 
-    if gender_form not in ALLOWED_GENDERS:
-        gender_form = "unspecified"
 
+def _system_messages_by_lang(*instructions: str) -> Dict[str, tuple]:
+    # статичные system-блоки (инструкция, правила) идут первыми и одинаковы
+    # для всех языков — общий префикс для prompt cache OpenAI; язык — после них
     return {
-        "animal": animal,
-        "element": element,
-        "genderForm": gender_form,
+        lang: (
+            *({"role": "system", "content": text} for text in instructions),
+            {"role": "system", "content": language_rule},
+        )
+        for lang, language_rule in LANG_INSTRUCTIONS.items()
     }
 
 
-def generate_short_text(prompt: str, lang: str) -> str:
+SHORT_ANALYSIS_MESSAGES = _system_messages_by_lang(SYSTEM_SHORT_ANALYSIS)
+SHORT_TEXT_MESSAGES = _system_messages_by_lang(SYSTEM_SHORT_TEXT, SHORT_TEXT_RULES)
+FULL_ANALYSIS_MESSAGES = _system_messages_by_lang(
+    SYSTEM_FULL_ANALYSIS, FULL_ANALYSIS_RULES
+)
+
+
+def _build_input(system_messages: Dict[str, tuple], lang: str, prompt: str) -> list:
+    head = system_messages.get(lang, system_messages["ru"])
+    return [*head, {"role": "user", "content": prompt}]
+
 
-    language_rule = LANG_INSTRUCTIONS.get(lang, LANG_INSTRUCTIONS["ru"])
-    system_instruction = f"""
-{language_rule}
+def _interned(value):
+    return sys.intern(value) if isinstance(value, str) else value
 
-Ты генерируешь КОРОТКИЙ результат по системе «24 зверя × 4 стихии».
-Строго соблюдай структуру из промпта пользователя.
-Не добавляй лишних блоков.
-""".strip()
 
-    response = client.responses.create(
-        model="gpt-4.1-mini",
-        input=[
-            {"role": "system", "content": system_instruction},
-            {"role": "user", "content": prompt},
-        ],
-        max_output_tokens=520,
+def _log_cache_usage(response) -> None:
+    # сколько входных токенов пришло из prompt cache OpenAI
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "input_tokens_details", None)
+    logger.debug(
+        "openai model=%s input_tokens=%s cached_tokens=%s",
+        getattr(response, "model", None),
+        getattr(usage, "input_tokens", None),
+        getattr(details, "cached_tokens", None),
     )
 
+
+def _response_text(response) -> str:
+    # быстрый путь — только для ровно одного message с одним output_text;
+    # иначе (несколько блоков, reasoning, refusal) output_text склеит всё сам
+    output = getattr(response, "output", None) or ()
+    if len(output) == 1 and getattr(output[0], "type", None) == "message":
+        content = getattr(output[0], "content", None) or ()
+        if len(content) == 1 and getattr(content[0], "type", None) == "output_text":
+            return content[0].text.strip()
     return (response.output_text or "").strip()
 
 
-def run_full_analysis(prompt: str, lang: str) -> str:
-    language_rule = LANG_INSTRUCTIONS.get(lang, LANG_INSTRUCTIONS["ru"])
+async def run_short_analysis(prompt: str, lang: str) -> Tuple[dict, bool]:
+    """Возвращает (коды, был ли hit)."""
+
+    async def compute() -> dict:
+        async with _openai_semaphore:
+            response = await client.responses.create(
+                model="gpt-4.1-mini",
+                input=_build_input(SHORT_ANALYSIS_MESSAGES, lang, prompt),
+                max_output_tokens=120,
+                # JSON mode: модель отдаёт только объект, без текста вокруг
+                text={"format": {"type": "json_object"}},
+            )
 
-    system_instruction = f"""
-{language_rule}
+        _log_cache_usage(response)
+        data = orjson.loads(_response_text(response))
 
-Ты формируешь ПОЛНЫЙ психологический профиль
-в системе «24 зверя × 4 стихии».
+        animal = _interned(data.get("animal"))
+        element = _interned(data.get("element"))
+        gender_form = _interned(data.get("genderForm") or "unspecified")
 
-❗ Архетип и стихия УЖЕ ЗАДАНЫ.
-❗ НЕ изменяй архетип.
-❗ НЕ добавляй новых животных.
-❗ НЕ используй метафоры вместо названий.
+        # 🛡️ строгая валидация (сначала меньший набор)
+        if element not in ALLOWED_ELEMENTS:
+            raise ValueError(f"Invalid element: {element}")
 
-СТРОГО соблюдай структуру полного профиля.
-""".strip()
+        if animal not in ALLOWED_ANIMALS:
+            raise ValueError(f"Invalid animal: {animal}")
 
-    response = client.responses.create(
-        model="gpt-4.1",
-        input=[
-            {
-                "role": "system",
-                "content": system_instruction,
-            },
-            {"role": "user", "content": prompt},
-        ],
-        max_output_tokens=1200,  # достаточно для full-профиля
+        if gender_form not in ALLOWED_GENDERS:
+            gender_form = "unspecified"
+
+        return {
+            "animal": animal,
+            "element": element,
+            "genderForm": gender_form,
+        }
+
+    codes, hit = await _response_cache.get_or_compute(
+        make_key(PROMPT_VERSION, "gpt-4.1-mini", "codes", lang, prompt),
+        compute,
     )
+    return dict(codes), hit
 
-    return (response.output_text or "").strip()
+
+async def generate_short_text(prompt: str, lang: str) -> Tuple[str, bool]:
+    """Возвращает (текст, был ли hit)."""
+
+    async def compute() -> str:
+        async with _openai_semaphore:
+            response = await client.responses.create(
+                model="gpt-4.1-mini",
+                input=_build_input(SHORT_TEXT_MESSAGES, lang, prompt),
+                max_output_tokens=520,
+            )
+
+        _log_cache_usage(response)
+        return _response_text(response)
+
+    return await _response_cache.get_or_compute(
+        make_key(PROMPT_VERSION, "gpt-4.1-mini", "short", lang, prompt), compute
+    )
+
+
+def _full_cache_key(prompt: str, lang: str) -> str:
+    return make_key(PROMPT_VERSION, "gpt-4.1", "full", lang, prompt)
+
+
+async def run_full_analysis(prompt: str, lang: str) -> Tuple[str, bool]:
+    """Возвращает (текст, был ли hit)."""
+
+    async def compute() -> str:
+        async with _openai_semaphore:
+            response = await client.responses.create(
+                model="gpt-4.1",
+                input=_build_input(FULL_ANALYSIS_MESSAGES, lang, prompt),
+                max_output_tokens=1200,  # достаточно для full-профиля
+            )
+
+        _log_cache_usage(response)
+        return _response_text(response)
+
+    return await _response_cache.get_or_compute(_full_cache_key(prompt, lang), compute)
+
+
+async def stream_full_analysis(prompt: str, lang: str) -> AsyncIterator[str]:
+    cache_key = _full_cache_key(prompt, lang)
+    cached = _response_cache.get(cache_key)
+    if cached is not None:
+        yield cached
+        return
+
+    # апстрим читает отдельная задача: слот семафора освобождается, как только
+    # OpenAI закончил ответ, а не когда медленный клиент дочитал SSE
+    deltas: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+
+    async def pump() -> None:
+        parts = []
+        try:
+            async with _openai_semaphore, client.responses.stream(
+                model="gpt-4.1",
+                input=_build_input(FULL_ANALYSIS_MESSAGES, lang, prompt),
+                max_output_tokens=1200,  # достаточно для full-профиля
+            ) as stream:
+                async for event in stream:
+                    if event.type == "response.output_text.delta":
+                        parts.append(event.delta)
+                        deltas.put_nowait(event.delta)
+        finally:
+            deltas.put_nowait(None)
+
+        text = "".join(parts).strip()
+        if text:
+            _response_cache.set(cache_key, text)
+
+    producer = asyncio.ensure_future(pump())
+    # ошибку апстрима забираем всегда, даже если клиент ушёл раньше
+    producer.add_done_callback(lambda task: task.cancelled() or task.exception())
+    try:
+        while True:
+            delta = await deltas.get()
+            if delta is None:
+                break
+            yield delta
+        await producer
+    finally:
+        # клиент отключился до конца ответа — апстрим больше не нужен
+        producer.cancel()
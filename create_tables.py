@@ -13,11 +13,11 @@ async def main() -> None:
 
     try:
         from db import engine
-        from models import Base
+        from schema import ensure_schema
 
         async with engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
-        print("OK: tables created")
+            created = await ensure_schema(conn)
+        print("OK: tables created" if created else "OK: tables exist")
     except Exception as exc:  # noqa: BLE001
         print(exc)
         sys.exit(1)
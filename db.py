@@ -1,8 +1,30 @@
 import os
+from typing import AsyncIterator
 
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+if not DATABASE_URL:
+    raise RuntimeError("DATABASE_URL is not set")
+if not DATABASE_URL.startswith("postgresql+asyncpg://"):
+    raise RuntimeError("DATABASE_URL must use the postgresql+asyncpg:// driver")
 
-engine = create_async_engine(DATABASE_URL)
+engine = create_async_engine(
+    DATABASE_URL,
+    pool_size=20,
+    max_overflow=20,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    connect_args={
+        "statement_cache_size": 1024,
+        "prepared_statement_cache_size": 256,
+        # короткие OLTP-запросы: JIT только добавляет время планирования
+        "server_settings": {"jit": "off"},
+    },
+)
 SessionLocal = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+
+async def get_session() -> AsyncIterator[AsyncSession]:
+    async with SessionLocal() as session:
+        yield session
@@ -0,0 +1,87 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+
+class TTLCache:
+    """In-process LRU с ограничением по размеру и времени жизни записи."""
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+        # вычисления в процессе: пока первый запрос считает значение,
+        # остальные ждут ту же задачу и получают её результат или ошибку
+        self._inflight: Dict[str, "asyncio.Future[Any]"] = {}
+
+    def get(self, key: str) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Any]],
+        ttl: Optional[float] = None,
+    ) -> Tuple[Any, bool]:
+        """Возвращает (значение, был ли hit). Пустые значения не кешируются.
+
+        Одновременные промахи по одному ключу вычисляются один раз: ожидающие
+        получают результат (hit) или исключение первого вычисления.
+        """
+        cached = self.get(key)
+        if cached is not None:
+            return cached, True
+        task = self._inflight.get(key)
+        owner = task is None
+        if owner:
+            task = asyncio.ensure_future(self._compute_and_store(key, compute, ttl))
+            task.add_done_callback(_consume_exception)
+            self._inflight[key] = task
+        # shield: отмена одного ожидающего не отменяет общее вычисление
+        return await asyncio.shield(task), not owner
+
+    async def _compute_and_store(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Any]],
+        ttl: Optional[float],
+    ) -> Any:
+        try:
+            value = await compute()
+            if value:
+                self.set(key, value, ttl)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+
+def _consume_exception(task: "asyncio.Future[Any]") -> None:
+    # если все ожидающие отменились, ошибку никто не заберёт — без этого
+    # asyncio пишет в лог "exception was never retrieved"
+    if not task.cancelled():
+        task.exception()
+
+
+def make_key(*parts: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
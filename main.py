@@ -1,31 +1,106 @@
+import asyncio
+import contextlib
+import logging
+import logging.handlers
 import os
+import queue
 import uuid
 
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), ".env"))
 
-from sqlalchemy import text as sql_text
-from fastapi import FastAPI, HTTPException
+from sqlalchemy import delete, insert, select, text as sql_text
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 import re
+from operator import attrgetter
 from typing import Dict, List, Optional, Union
+from ai import client as openai_client
 from ai import run_short_analysis, generate_short_text, run_full_analysis
-from db import SessionLocal, engine
-from models import Base, Run, RunAnswer, ShortResultORM, FullResultORM
+from ai import stream_full_analysis
+from db import SessionLocal, engine, get_session
+from llm_cache import make_key
+from models import Run, RunAnswer, ShortResultORM, FullResultORM
+from schema import ensure_schema
 from utils_animals import get_animal_ru_name, build_image_key
 
 app = FastAPI()
 
+# запись в stdout делает отдельный поток: обработчик лишь кладёт запись в очередь
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(
+    logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+)
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+
+logger = logging.getLogger("reino_backend")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+if not logger.handlers:
+    logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+
+
+class UnhandledErrorMiddleware:
+    """Превращает необработанную ошибку в общий 500 и пишет её в лог один раз.
+
+    Подключается до CORSMiddleware, то есть работает внутри неё: ответ с 500
+    тоже получает CORS-заголовки. Обработчик Exception у приложения сработал бы
+    в ServerErrorMiddleware — снаружи CORS и с повторным логом от uvicorn.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        response_started = False
+
+        async def send_tracking(message) -> None:
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_tracking)
+        except Exception:
+            if response_started:
+                # заголовки уже ушли — 500 не отправить, пусть сервер закроет ответ
+                raise
+            logger.exception(
+                "Unhandled error on %s %s", scope["method"], scope["path"]
+            )
+            response = JSONResponse(
+                status_code=500,
+                content={"detail": "Internal Server Error"},
+            )
+            await response(scope, receive, send)
+
 
 # -------------------- MODELS --------------------
 @app.on_event("startup")
 async def on_startup():
+    log_listener.start()
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        await ensure_schema(conn)
+
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    await openai_client.close()
+    log_listener.stop()
 
+
+# порядок важен: добавленная раньше middleware оказывается внутри CORS
+app.add_middleware(UnhandledErrorMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -104,97 +179,55 @@ class AnalyzeResponse(BaseModel):
 ANSWER_KEY_RE = re.compile(r"^answer_(\d+)$")
 
 
+_question_and_answer = attrgetter("questionId", "answer")
+
+
 def build_answers_text(answers: List[TestAnswer]) -> str:
-    return "\n".join(f"Q{a.questionId}: {a.answer}" for a in answers if a.answer)
+    return "\n".join(
+        "Q%s: %s" % qa for qa in map(_question_and_answer, answers) if qa[1]
+    )
 
 
-def build_short_prompt(
+def build_codes_prompt(
     name: str,
     lang: str,
     gender: str,
-    animal_ru: str,
-    element_ru: str,
-    answers_text: str,
+    answers: List[TestAnswer],
 ) -> str:
+    # пробелы в ответах схлопываются в самом промпте, а не только в ключе:
+    # промпт целиком и есть ключ кеша кодов — модель видит ровно то, что кешируется
+    answers_text = "\n".join(
+        "Q%s: %s" % (question_id, " ".join(answer.split()))
+        for question_id, answer in map(_question_and_answer, answers)
+        if answer.strip()
+    )
     return f"""
-❗ ВАЖНО:
-Используй ТОЛЬКО ЭТО животное:
-{animal_ru}
-
-❌ Запрещено:
-– заменять животное
-– использовать других птиц или зверей
-– вводить новые образы
-
-❗ ЯЗЫК (ОБЯЗАТЕЛЬНО)
-Пиши ВЕСЬ текст СТРОГО на языке: {lang}
-
-Если язык:
-ru — русский  
-en — английский  
-es — испанский  
-pt — португальский  
-
-Запрещено:
-– смешивать языки
-– использовать русский, если lang ≠ ru
-– добавлять перевод в скобках
-Даже если они кажутся более подходящими.
-Ты - аналитическая ИИ-модель, определяющая архетип зверя (строго из списка 24) и стихию (Огонь, Вода, Воздух, Земля) на основе ответов пользователя.
-Твоя задача — выдать короткий психологический профиль,
-сохраняя все правила системы, выводя только ключевые блоки, включая итоговое заключение,
-в форме, удобной и естественной именно для данного пользователя.
-
-1️⃣ ЛОГИКА УЧЁТА ПОЛА
-Пол НЕ влияет на анализ.
-Пол влияет ТОЛЬКО на форму названия архетипа.
-Если пол не указан — используй мужскую (нейтральную) форму.
+Имя: {name}
+Язык: {lang}
 Пол: {gender}
 
-2️⃣ АЛГОРИТМ АНАЛИЗА (ВНУТРЕННИЙ)
-Проанализируй ответы пользователя по 10 осям.
-Сравни модель пользователя с критериями всех 24 зверей.
-❗ Не описывай алгоритм и не упоминай оси.
-
-3️⃣ ОБЯЗАТЕЛЬНЫЕ БЛОКИ
-В финальном выводе должны быть:
-– Архетип (животное + стихия)
-– Краткое общее описание
-– Ценности
-– Два наиболее ярких пункта личности
-– Заключение
-
-4️⃣ ОТЗЕРКАЛИВАНИЕ СТИЛЯ
-Текст должен читаться как «про меня».
-
-5️⃣ СТРОГАЯ СТРУКТУРА (НЕ МЕНЯТЬ)
-
-{name} — {animal_ru} {element_ru} {{ЗНАЧОК}}
-{{Короткая строка-образ. 3–7 слов.}}
-
-{{Краткое общее описание — 1–2 абзаца}}
-
-🧭 Ценности — «{{3–4 ключевых слова}}»
-• …
-• …
-• …
-• …
-
-{{Пункт 1 — самый яркий}}
-{{ЗНАЧОК}} {{Название пункта}} — «{{Метафорическое название}}»
-{{Короткое описание}}
+Ответы пользователя:
+{answers_text}
+""".strip()
 
-{{Пункт 2 — второй по яркости}}
-{{ЗНАЧОК}} {{Название пункта}} — «{{Метафорическое название}}»
-{{Короткое описание}}
 
-🧩 Заключение
-{{Интегральный вывод}}
+# правила лежат в prompts/*_rules.txt и уходят system-сообщениями (см. ai.py);
+# здесь собирается только переменная часть — данные пользователя
 
-6️⃣ СТИЛЬ
-Тон: взрослый, спокойный, уверенный.
-Запрещено: «возможно», «кажется», эзотерика, объяснение анализа.
 
+def build_short_prompt(
+    name: str,
+    lang: str,
+    gender: str,
+    animal_ru: str,
+    element_ru: str,
+    answers_text: str,
+) -> str:
+    return f"""
+ДАННЫЕ ПОЛЬЗОВАТЕЛЯ
+Архетип: {animal_ru}
+Стихия: {element_ru}
+Пол: {gender}
 Имя пользователя: {name}
 Язык: {lang}
 
@@ -211,106 +244,12 @@ def build_full_prompt(
     element: str,
     answers_text: str,
 ) -> str:
-
     return f"""
-Ты — аналитическая ИИ-модель, формирующая полный психологический профиль личности
-на основе заданного архетипа зверя, заданной стихии и ответов пользователя
-в системе «24 зверя × 4 стихии».
-
-Архетип зверя и стихия ЗАДАНЫ и НЕ ПЕРЕСМАТРИВАЮТСЯ.
-
+ДАННЫЕ ПОЛЬЗОВАТЕЛЯ
+Имя: {name}
 Архетип: {animal}
 Стихия: {element}
 Пол: {gender}
-
-1️⃣ СИСТЕМА И ГРАНИЦЫ
-Система включает:
-матрицу 24 архетипов зверей;
-4 стихии: Огонь, Вода, Воздух, Земля;
-10 внутренних аналитических осей.
-Пол:
-НЕ влияет на анализ;
-влияет ТОЛЬКО на форму названия архетипа.
-Используй СТРОГО утверждённые формы архетипов
-(список форм — без изменений).
-Если пол не указан — используй мужскую (нейтральную) форму.
-2️⃣ АЛГОРИТМ АНАЛИЗА (ВНУТРЕННИЙ)
-Архетип зверя и стихия заданы.
-Проанализируй ответы пользователя по 10 внутренним осям:
-темп
-энергия
-конфликтность
-социальность
-стиль мышления
-стиль действий
-стресс-реакция
-вектор энергии
-ориентация
-функция архетипа
-На основе анализа:
-раскрой проявление стихии внутри данного архетипа;
-сформируй целостный психологический портрет;
-не изменяй входные параметры.
-❗️
-Не упоминай оси.
-Не описывай механику.
-3️⃣ ПОДАЧА С ОТЗЕРКАЛИВАНИЕМ (КРИТИЧЕСКИ ВАЖНО)
-Стиль подачи обязан учитывать:
-архетип зверя;
-стихию;
-темп и характер ответов пользователя.
-Правило отзеркаливания
-Текст должен быть написан в ритме, интонации и плотности,
-которые комфортны именно этому архетипу и этому человеку.
-Примеры (внутренние, не упоминать в ответе):
-для Земли → спокойный, устойчивый, размеренный, без резких формулировок;
-для Воздуха → ясный, структурный, лёгкий, логичный;
-для Воды → тёплый, эмпатичный, поддерживающий;
-для Огня → прямой, собранный, энергичный, уверенный.
-Если ответы пользователя:
-осторожные → подача мягче;
-прямые → подача прямее;
-рефлексивные → глубже;
-лаконичные → без избыточных украшений.
-❗️
-Отзеркаливание НЕ должно:
-искажать смысл;
-упрощать глубину;
-менять структуру.
-Цель — чтобы текст читался как «про меня и моим языком».
-4️⃣ СТИЛЬ И ЗАПРЕТЫ
-Общий стиль:
-взрослый
-спокойный
-уверенный
-человеческий
-Запрещено:
-«возможно», «кажется», «вероятно»;
-эзотерика и мистика;
-диагнозы;
-объяснение механики работы модели.
-5️⃣ ЭМОДЗИ
-Используй эмодзи:
-одного визуального стиля;
-одного масштаба;
-строго по разделам (как в эталоне).
-6️⃣ СТРОГАЯ СТРУКТУРА ВЫВОДА (НЕ МЕНЯТЬ):
-{name} — {{Архетип (с учётом пола)}} {element}
-(краткое описание архетипа в скобках)
-1. Общий психопрофиль
-2. Энергетический профиль
-3. Стиль мышления
-4. Социальное взаимодействие
-5. Конфликтность и поведение в напряжённых ситуациях
-6. Ценности
-7. Профессиональный стиль
-8. Сильные стороны
-9. Потенциальные слабые стороны
-10. Жизненный путь
-Итог
-7️⃣ КЛЮЧЕВОЕ ПРАВИЛО
-Ты не просто описываешь архетип.
-Ты говоришь с человеком на его языке.
 Язык: {lang}
 Ответы пользователя:
 {answers_text}
@@ -330,30 +269,87 @@ def normalize_answers(
         match = ANSWER_KEY_RE.match(key)
         if not match or value is None:
             continue
-        normalized.append(TestAnswer(questionId=int(match.group(1)), answer=str(value)))
+        # поля уже приведены к int/str — повторная валидация pydantic не нужна
+        normalized.append(
+            TestAnswer.model_construct(
+                questionId=int(match.group(1)), answer=str(value)
+            )
+        )
     normalized.sort(key=lambda item: item.questionId)
     return normalized
 
 
-@app.post("/analyze/short", response_model=ShortResponse)
-async def analyze_short(payload: TestPayload):
-    try:
-        print("📥 SHORT payload:", payload)
+async def save_run_answers(
+    session: AsyncSession,
+    run_id: uuid.UUID,
+    answers: List[TestAnswer],
+) -> None:
+    # Core executemany: без ORM-объекта на каждый ответ
+    if not answers:
+        return
+    await session.execute(
+        insert(RunAnswer),
+        [
+            {"run_id": run_id, "question_id": a.questionId, "answer": a.answer}
+            for a in answers
+        ],
+    )
+
+
+async def save_run(
+    run_id: uuid.UUID,
+    payload: TestPayload,
+    answers: List[TestAnswer],
+) -> None:
+    async with SessionLocal() as session:
+        session.add(
+            Run(
+                id=run_id,
+                name=payload.name,
+                lang=payload.lang,
+                gender=payload.gender or "unspecified",
+            )
+        )
+        await session.flush()
+        await save_run_answers(session, run_id, answers)
+        await session.commit()
+
 
-        answers_text = build_answers_text(payload.answers)
-        normalized_answers = normalize_answers(payload.answers)
-        answers_text = build_answers_text(normalized_answers)
+async def discard_run(run_id: uuid.UUID) -> None:
+    # анализ не удался, а прогон уже записан — убираем его, чтобы не было сирот
+    try:
+        async with SessionLocal() as session:
+            await session.execute(delete(RunAnswer).where(RunAnswer.run_id == run_id))
+            await session.execute(delete(Run).where(Run.id == run_id))
+            await session.commit()
+    except Exception:
+        logger.exception("DISCARD RUN ERROR run_id=%s", run_id)
 
-        codes = run_short_analysis(
-            prompt=f"""
-Имя: {payload.name}
-Язык: {payload.lang}
-Пол: {payload.gender or "unspecified"}
 
-Ответы пользователя:
-{answers_text}
-""".strip(),
-            lang=payload.lang,
+@app.post("/analyze/short", response_model=ShortResponse)
+async def analyze_short(
+    payload: TestPayload,
+    response: Response,
+    session: AsyncSession = Depends(get_session),
+):
+    logger.debug(
+        "SHORT payload lang=%s gender=%s answers=%d",
+        payload.lang,
+        payload.gender,
+        len(payload.answers),
+    )
+
+    gender = payload.gender or "unspecified"
+    normalized_answers = normalize_answers(payload.answers)
+    answers_text = build_answers_text(normalized_answers)
+
+    # прогон и ответы не зависят от модели — пишем их, пока идут LLM-вызовы
+    run_id = uuid.uuid4()
+    run_saved = asyncio.create_task(save_run(run_id, payload, normalized_answers))
+    try:
+        codes, codes_hit = await run_short_analysis(
+            build_codes_prompt(payload.name, payload.lang, gender, normalized_answers),
+            payload.lang,
         )
 
         animal_ru = get_animal_ru_name(
@@ -365,76 +361,102 @@ async def analyze_short(payload: TestPayload):
         text_prompt = build_short_prompt(
             name=payload.name,
             lang=payload.lang,
-            gender=payload.gender or "unspecified",
+            gender=gender,
             animal_ru=animal_ru,
             element_ru=codes["element"],  # ✅ ВАЖНО: тут RU-стихия
             answers_text=answers_text,
         )
-        text = generate_short_text(text_prompt, payload.lang)
-        run_id = uuid.uuid4()
-        async with SessionLocal() as session:
-            session.add(
-                Run(
-                    id=run_id,
-                    name=payload.name,
-                    lang=payload.lang,
-                    gender=payload.gender or "unspecified",
-                )
+        text, text_hit = await generate_short_text(text_prompt, payload.lang)
+        response.headers["X-Cache"] = "HIT" if codes_hit and text_hit else "MISS"
+
+        await run_saved
+        session.add(
+            ShortResultORM(
+                run_id=run_id,
+                animal=codes["animal"],
+                element=codes["element"],
+                gender_form=codes["genderForm"],
+                text=text,
             )
-            session.add_all(
-                [
-                    RunAnswer(
-                        run_id=run_id,
-                        question_id=answer.questionId,
-                        answer=answer.answer,
-                    )
-                    for answer in normalized_answers
-                ]
-            )
-            session.add(
-                ShortResultORM(
-                    run_id=run_id,
-                    animal=codes["animal"],
-                    element=codes["element"],
-                    gender_form=codes["genderForm"],
-                    text=text,
-                )
-            )
-            await session.commit()
+        )
+        await session.commit()
+    except BaseException:
+        run_saved.cancel()
+        # забираем результат задачи, иначе её ошибка всплывёт в лог как
+        # "Task exception was never retrieved"
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await run_saved
+        await discard_run(run_id)
+        raise
 
-        return {
-            "type": "short",
-            "result": {
-                "runId": str(run_id),
-                "animal": codes["animal"],
-                "element": codes["element"],  # ✅ RU: Огонь/Вода/Воздух/Земля
-                "genderForm": codes["genderForm"],
-                "text": text,
-            },
-        }
+    return {
+        "type": "short",
+        "result": {
+            "runId": str(run_id),
+            "animal": codes["animal"],
+            "element": codes["element"],  # ✅ RU: Огонь/Вода/Воздух/Земля
+            "genderForm": codes["genderForm"],
+            "text": text,
+        },
+    }
+
+
+def result_etag(run_uuid: uuid.UUID, *parts: str) -> str:
+    return f'"{make_key(str(run_uuid), *parts)}"'
 
-    except Exception as e:
-        print("❌ SHORT ERROR:", repr(e))
-        raise HTTPException(status_code=500, detail=str(e))
+
+def not_modified(request: Request, etag: str) -> bool:
+    # RFC 9110 13.1.2: список через запятую, слабое сравнение (W/ игнорируется),
+    # "*" совпадает с любым существующим представлением
+    header = ",".join(request.headers.getlist("if-none-match"))
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
 
 
 @app.get("/result/short/{runId}", response_model=ShortResponse)
-async def get_short_result(runId: str):
+async def get_short_result(
+    runId: str,
+    request: Request,
+    response: Response,
+    session: AsyncSession = Depends(get_session),
+):
     try:
         run_uuid = uuid.UUID(runId)
     except ValueError:
         raise HTTPException(status_code=404, detail="Short result not found")
 
-    async with SessionLocal() as session:
-        result = await session.get(ShortResultORM, run_uuid)
+    # только колонки: без ORM-объекта и identity map на чтение
+    result = (
+        await session.execute(
+            select(
+                ShortResultORM.animal,
+                ShortResultORM.element,
+                ShortResultORM.gender_form,
+                ShortResultORM.text,
+            ).where(ShortResultORM.run_id == run_uuid)
+        )
+    ).first()
 
     if result is None:
         raise HTTPException(status_code=404, detail="Short result not found")
 
+    # результат по runId не меняется — повторный запрос клиента получает 304
+    etag = result_etag(run_uuid, *result)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
     return {
         "type": "short",
         "result": {
-            "runId": str(result.run_id),
+            "runId": str(run_uuid),
             "animal": result.animal,
             "element": result.element,
             "genderForm": result.gender_form,
@@ -444,127 +466,200 @@ async def get_short_result(runId: str):
 
 
 @app.post("/analyze", response_model=AnalyzeResponse)
-def analyze(payload: AnalyzeRequest):
-    try:
-        print("📥 ANALYZE payload:", payload)
-
-        answers_text = build_answers_text(payload.answers)
+async def analyze(payload: AnalyzeRequest, response: Response):
+    logger.debug(
+        "ANALYZE payload lang=%s gender=%s answers=%d",
+        payload.lang,
+        payload.gender,
+        len(payload.answers),
+    )
+
+    gender = payload.gender or "unspecified"
+    answers_text = build_answers_text(payload.answers)
+
+    codes, codes_hit = await run_short_analysis(
+        build_codes_prompt(payload.name, payload.lang, gender, payload.answers),
+        payload.lang,
+    )
+
+    animal_ru = get_animal_ru_name(
+        animal_code=codes["animal"],
+        gender=codes["genderForm"],
+    )
+
+    text_prompt = build_short_prompt(
+        name=payload.name,
+        lang=payload.lang,
+        gender=gender,
+        animal_ru=animal_ru,
+        element_ru=codes["element"],
+        answers_text=answers_text,
+    )
+    text, text_hit = await generate_short_text(text_prompt, payload.lang)
+    response.headers["X-Cache"] = "HIT" if codes_hit and text_hit else "MISS"
+    image_key = build_image_key(
+        animal_code=codes["animal"],
+        element=codes["element"],
+        gender=codes["genderForm"],
+    )
 
-        codes = run_short_analysis(
-            prompt=f"""
-Имя: {payload.name}
-Язык: {payload.lang}
-Пол: {payload.gender or "unspecified"}
+    return {
+        "type": "short",
+        "result": {
+            "animal": codes["animal"],
+            "element": codes["element"],
+            "genderForm": codes["genderForm"],
+            "imageKey": image_key,
+            "text": text,
+        },
+    }
 
-Ответы пользователя:
-{answers_text}
-""".strip(),
-            lang=payload.lang,
-        )
 
-        animal_ru = get_animal_ru_name(
-            animal_code=codes["animal"],
-            gender=codes["genderForm"],
-        )
+@app.post("/analyze/full", response_model=FullResponse)
+async def analyze_full(
+    payload: FullPayload,
+    response: Response,
+    session: AsyncSession = Depends(get_session),
+):
+    logger.debug(
+        "FULL payload runId=%s lang=%s animal=%s element=%s",
+        payload.runId,
+        payload.lang,
+        payload.animal,
+        payload.element,
+    )
 
-        text_prompt = build_short_prompt(
-            name=payload.name,
-            lang=payload.lang,
-            gender=payload.gender or "unspecified",
-            animal_ru=animal_ru,
-            element_ru=codes["element"],
-            answers_text=answers_text,
-        )
-        text = generate_short_text(text_prompt, payload.lang)
-        image_key = build_image_key(
-            animal_code=codes["animal"],
-            element=codes["element"],
-            gender=codes["genderForm"],
+    try:
+        run_uuid = uuid.UUID(payload.runId)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid runId")
+
+    normalized_answers = normalize_answers(payload.answers)
+    answers_text = build_answers_text(normalized_answers)
+
+    prompt = build_full_prompt(
+        name=payload.name,
+        lang=payload.lang,
+        gender=payload.gender,
+        animal=payload.animal,
+        element=payload.element,
+        answers_text=answers_text,
+    )
+
+    text, text_hit = await run_full_analysis(prompt, payload.lang)
+    response.headers["X-Cache"] = "HIT" if text_hit else "MISS"
+
+    session.add(
+        FullResultORM(
+            run_id=run_uuid,
+            text=text,
         )
+    )
+    await session.commit()
 
-        return {
-            "type": "short",
-            "result": {
-                "animal": codes["animal"],
-                "element": codes["element"],
-                "genderForm": codes["genderForm"],
-                "imageKey": image_key,
-                "text": text,
-            },
-        }
+    return {
+        "type": "full",
+        "result": {"runId": payload.runId, "text": text},
+    }
 
-    except Exception as e:
-        print("❌ ANALYZE ERROR:", repr(e))
-        raise HTTPException(status_code=500, detail=str(e))
 
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
 
-@app.post("/analyze/full", response_model=FullResponse)
-async def analyze_full(payload: FullPayload):
-    try:
-        print("📥 FULL payload:", payload)
 
-        try:
-            run_uuid = uuid.UUID(payload.runId)
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid runId")
+@app.post("/analyze/full/stream")
+async def analyze_full_stream(payload: FullPayload):
+    logger.debug(
+        "FULL STREAM payload runId=%s lang=%s animal=%s element=%s",
+        payload.runId,
+        payload.lang,
+        payload.animal,
+        payload.element,
+    )
 
-        normalized_answers = normalize_answers(payload.answers)
-        answers_text = build_answers_text(normalized_answers)
+    try:
+        run_uuid = uuid.UUID(payload.runId)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid runId")
 
-        prompt = build_full_prompt(
-            name=payload.name,
-            lang=payload.lang,
-            gender=payload.gender,
-            animal=payload.animal,
-            element=payload.element,
-            answers_text=answers_text,
-        )
+    normalized_answers = normalize_answers(payload.answers)
+    answers_text = build_answers_text(normalized_answers)
 
-        text = run_full_analysis(prompt, payload.lang)
+    prompt = build_full_prompt(
+        name=payload.name,
+        lang=payload.lang,
+        gender=payload.gender,
+        animal=payload.animal,
+        element=payload.element,
+        answers_text=answers_text,
+    )
 
-        async with SessionLocal() as session:
-            session.add(
-                FullResultORM(
-                    run_id=run_uuid,
-                    text=text,
+    async def events():
+        try:
+            parts = []
+            async for delta in stream_full_analysis(prompt, payload.lang):
+                parts.append(delta)
+                yield sse_event("delta", {"text": delta})
+
+            text = "".join(parts).strip()
+            if not text:
+                # пустой отчёт не сохраняем: иначе GET отдавал бы его навсегда
+                logger.error("FULL STREAM EMPTY runId=%s", payload.runId)
+                yield sse_event("error", {"detail": "Ошибка анализа"})
+                return
+
+            async with SessionLocal() as session:
+                session.add(
+                    FullResultORM(
+                        run_id=run_uuid,
+                        text=text,
+                    )
                 )
-            )
-            await session.commit()
+                await session.commit()
+
+            yield sse_event("done", {"runId": payload.runId})
 
-        return {
-            "type": "full",
-            "result": {"runId": payload.runId, "text": text},
-        }
+        except Exception:
+            logger.exception("FULL STREAM ERROR")
+            yield sse_event("error", {"detail": "Ошибка анализа"})
 
-    except Exception as e:
-        print("❌ FULL ANALYSIS ERROR:", e)
-        raise HTTPException(status_code=500, detail="Ошибка анализа")
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 
 @app.get("/result/full/{runId}", response_model=FullResponse)
-async def get_full_result(runId: str):
+async def get_full_result(
+    runId: str,
+    request: Request,
+    response: Response,
+    session: AsyncSession = Depends(get_session),
+):
     try:
         run_uuid = uuid.UUID(runId)
     except ValueError:
         raise HTTPException(status_code=404, detail="Full result not found")
 
-    async with SessionLocal() as session:
-        result = await session.get(FullResultORM, run_uuid)
+    text = await session.scalar(
+        select(FullResultORM.text).where(FullResultORM.run_id == run_uuid)
+    )
 
-    if result is None:
+    if text is None:
         raise HTTPException(status_code=404, detail="Full result not found")
 
+    etag = result_etag(run_uuid, text)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
     return {
         "type": "full",
-        "result": {"runId": str(result.run_id), "text": result.text},
+        "result": {"runId": str(run_uuid), "text": text},
     }
 
 
 @app.get("/health/db")
-async def health_db():
+async def health_db(session: AsyncSession = Depends(get_session)):
     try:
-        async with SessionLocal() as session:
-            await session.execute(sql_text("SELECT 1"))
+        await session.execute(sql_text("SELECT 1"))
         return {"ok": True}
     except Exception as exc:
         return {"ok": False, "error": str(exc)}
@@ -0,0 +1,19 @@
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from models import Base
+
+# одна проверка всех таблиц вместо отдельного запроса на каждую внутри create_all
+TABLES_EXIST_SQL = text(
+    "SELECT "
+    + ", ".join(f"to_regclass('public.{name}')" for name in Base.metadata.tables)
+)
+
+
+async def ensure_schema(conn: AsyncConnection) -> bool:
+    """Создаёт недостающие таблицы. True — если они создавались."""
+    existing = (await conn.execute(TABLES_EXIST_SQL)).one()
+    created = not all(existing)
+    if created:
+        await conn.run_sync(Base.metadata.create_all)
+    return created
@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 ANIMAL_RU = {
     "Wolf": {"male": "Волк", "female": "Волчица"},
     "Lion": {"male": "Лев", "female": "Львица"},
@@ -41,6 +43,8 @@ ELEMENT_NUMBER = {
 FEMALE_SUFFIX_ANIMALS = {"Deer", "Fox", "Lion", "Ram"}
 
 
+# 24 животных × 4 стихии × 3 формы пола — ключей конечное число
+@lru_cache(maxsize=None)
 def build_image_key(animal_code: str, element: str, gender: str) -> str:
     element_number = ELEMENT_NUMBER.get(element)
     if not element_number: